@@ -1,17 +1,25 @@
 import argparse
+import concurrent.futures
+import json
 import logging
 import os
 import re
-import multiprocessing
 import subprocess
 import sys
-import time
+import threading
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
 DUMP_DIR_FLAG = '--dump-dir='
 
-SUPPORTED_PROFILES = [
+# Patterns used to parse the raw output of Volatility's imageinfo plugin
+PROFILE_REGEX = re.compile(rb'Suggested Profile\(s\) : ([^\n]*)')
+KDBG_REGEX = re.compile(rb'KDBG : (0x[a-fA-F0-9]*)')
+
+# Form of a KDBG offset accepted from the imageinfo cache
+KDBG_OFFSET_REGEX = re.compile(r'0x[a-fA-F0-9]+')
+
+SUPPORTED_PROFILES = frozenset([
 	"VistaSP0x64",
 	"VistaSP0x86",
 	"VistaSP1x64",
@@ -74,7 +82,7 @@ SUPPORTED_PROFILES = [
 	"WinXPSP2x64",
 	"WinXPSP2x86",
 	"WinXPSP3x86"
-]
+])
 
 BASE_PLUGINS = [
 	# Step 1: Identify Rogue Processes
@@ -137,21 +145,45 @@ ALL_PLUGINS = [
 	*NEWER_WINDOWS_PLUGINS
 ]
 
+# Rough relative runtime of the slower plugins. Tasks are started longest-first so a heavy plugin
+# doesn't begin last and hold up the whole run; plugins not listed here use DEFAULT_PLUGIN_WEIGHT.
+PLUGIN_WEIGHTS = {
+	'memdump': 100,
+	'dumpfiles': 90,
+	'procdump': 80,
+	'apihooks': 70,
+	'malfind': 60,
+	'dlldump': 55,
+	'moddump': 50,
+	'filescan': 45,
+	'hollowfind': 40,
+	'handles': 35,
+	'psxview': 30,
+	'ldrmodules': 25,
+	'mutantscan': 20,
+	'psscan': 20,
+	'netscan': 20,
+	'connscan': 20,
+	'sockscan': 20,
+}
+DEFAULT_PLUGIN_WEIGHT = 10
+
 DEFAULT_OUTPUT_DIR = './'
 DEFAULT_VOL_INVOCATION = 'vol.py'
 DEFAULT_EXTRACT_ARTIFACTS = False
 MAX_SIMULTANEOUS_WORKERS = 6
+IMAGEINFO_CACHE_FILENAME = 'imageinfo_cache.json'
 
 
 class MemoryImage(object):
 	"""
 	Class representing a single memory image to analyze.
 
-	Initializing a class will run Volatility imageinfo plugin to determine profile and KDBG offset,
-	if they are not explicitly provided.
+	Call detect_profile_and_kdbg() to run Volatility imageinfo plugin to determine profile and
+	KDBG offset, if they are not explicitly provided.
 	"""
 	def __init__(self, invocation, image_path, profile, kdbg, master_output_directory,
-				 plugins_list, extract_artifacts):
+				 extract_artifacts):
 		self.invocation = invocation
 		# Basename contains file extension (ex: DC011.raw)
 		self.basename = os.path.basename(image_path)
@@ -165,63 +197,119 @@ class MemoryImage(object):
 		self.valid_plugins = []
 
 		# Create output directory if it doesn't exist
-		if not os.path.exists(self.output_directory):
-			os.makedirs(self.output_directory)  
+		os.makedirs(self.output_directory, exist_ok=True)
 		    
 		# If the provided profile is invalid, exit program
 		if self.profile:
 			if not self.profile in SUPPORTED_PROFILES:
-				logging.error('[{0}] Invalid profile {1} selected'.format(self.basename, self.profile))
+				logging.error('[%s] Invalid profile %s selected', self.basename, self.profile)
 				sys.exit()
 
+	def detect_profile_and_kdbg(self, imageinfo_cache):
+		"""
+		Determine the profile and KDBG offset of the image, running imageinfo if either is missing.
+
+		Auto-detected values are looked up in and added to imageinfo_cache, keyed by the image's
+		absolute path and invalidated when the image's size, modification time or the Volatility
+		invocation changes.
+		"""
 		# If either the profile or the kdbg offset are not provided,
-		# initiate imageinfo plugin.
+		# use cached imageinfo results or initiate imageinfo plugin.
 		if not self.profile or not self.kdbg:
-			logging.info('[{0}] Determining profile...'.format(self.basename))
-			output_filename = f'{self.image_name}_imageinfo.txt'
-			output_path = os.path.join(self.output_directory, output_filename)
-
-			result_bytes = subprocess.check_output([self.invocation, '-f', self.abspath, 'imageinfo'])
-			result_str = str(result_bytes)
-
-			with open(output_path, 'wb') as output:
-				output.write(result_bytes)
-
-			profiles_regex = re.search('Suggested Profile\(s\) : ([^\n]*)',  result_str)
-			auto_profiles = profiles_regex.group(1).split(', ')
-
-			kdbg_regex = re.search(r'KDBG : (0x[a-fA-F0-9]*)', result_str)
-			auto_kdbg = kdbg_regex.group(1)
+			image_stat = os.stat(self.abspath)
+			cached = self.get_cached_imageinfo(imageinfo_cache, image_stat)
+			if cached:
+				logging.info('[%s] Using cached imageinfo results', self.basename)
+				auto_profile = cached['profile']
+				auto_kdbg = cached['kdbg']
+			else:
+				auto_profile, auto_kdbg = self.run_imageinfo()
+				# Don't persist a bad detection, or every rerun would reuse it
+				if auto_profile in SUPPORTED_PROFILES and KDBG_OFFSET_REGEX.fullmatch(auto_kdbg):
+					imageinfo_cache[self.abspath] = {
+						'invocation': self.invocation,
+						'size': image_stat.st_size,
+						'mtime': int(image_stat.st_mtime),
+						'profile': auto_profile,
+						'kdbg': auto_kdbg
+					}
+				else:
+					logging.warning('[%s] Not caching unsupported profile %s or KDBG offset %s',
+						self.basename, auto_profile, auto_kdbg)
 
 		# If not already provided, select the first suggested profile
 		if not self.profile:
-			self.profile = auto_profiles[0]
-		logging.info('[{0}] Selected Profile: {1}'.format(self.basename, self.profile))
+			self.profile = auto_profile
+		logging.info('[%s] Selected Profile: %s', self.basename, self.profile)
 		
 		# If not already provided, select the first returned kdbg offset
 		if not self.kdbg:
 			self.kdbg = auto_kdbg
-		logging.info('[{0}] Selected KDBG Offset: {1}'.format(self.basename, self.kdbg))
+		logging.info('[%s] Selected KDBG Offset: %s', self.basename, self.kdbg)
+
+	def get_cached_imageinfo(self, imageinfo_cache, image_stat):
+		"""
+		Return the cached imageinfo entry for the image, or None if it is missing, stale or malformed.
+		"""
+		cached = imageinfo_cache.get(self.abspath)
+		if not isinstance(cached, dict):
+			return None
+		if (cached.get('invocation') != self.invocation
+				or cached.get('size') != image_stat.st_size
+				or cached.get('mtime') != int(image_stat.st_mtime)):
+			return None
+		if not isinstance(cached.get('profile'), str) or cached['profile'] not in SUPPORTED_PROFILES:
+			return None
+		if not isinstance(cached.get('kdbg'), str) or not KDBG_OFFSET_REGEX.fullmatch(cached['kdbg']):
+			return None
+		return cached
+
+	def run_imageinfo(self):
+		"""
+		Run Volatility imageinfo plugin against the image and save its output.
+
+		Returns:
+			- first suggested profile
+			- KDBG offset
+		"""
+		logging.info('[%s] Determining profile...', self.basename)
+		output_filename = f'{self.image_name}_imageinfo.txt'
+		output_path = os.path.join(self.output_directory, output_filename)
+
+		# Stream imageinfo output to disk as it is produced, keeping one copy for parsing
+		command = [self.invocation, '-f', self.abspath, 'imageinfo']
+		result_bytes = bytearray()
+		with open(output_path, 'wb') as output, \
+				subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+			for chunk in iter(lambda: process.stdout.read(65536), b''):
+				output.write(chunk)
+				result_bytes += chunk
+		if process.returncode:
+			raise subprocess.CalledProcessError(process.returncode, command)
 
-		# Populate plugin list for relevant OS type
-		self.populate_valid_plugins(plugins_list)
-		for plugin in self.valid_plugins:
-			plugin_name = plugin.split(' ')[0].strip('\n')
-			logging.info('[{0}] Queuing plugin: {1}'.format(self.basename, plugin_name))
-	
+		profiles_match = PROFILE_REGEX.search(result_bytes)
+		auto_profiles = profiles_match.group(1).decode().strip().split(', ')
+
+		kdbg_match = KDBG_REGEX.search(result_bytes)
+		auto_kdbg = kdbg_match.group(1).decode()
+
+		return auto_profiles[0], auto_kdbg
 
 	def populate_valid_plugins(self, plugins_list):
 		"""
 		Create list of valid Volatility plugins to run against an image.
+
+		Must be called after the profile is known (see detect_profile_and_kdbg).
 		"""
 		if plugins_list:
 			with open(plugins_list, 'r') as ifile:
 				for line in ifile:
-					self.valid_plugins.append(line)
+					if line.strip():
+						self.valid_plugins.append(line)
 		else:
 			valid_plugins = []
-			OSType = re.match('(WinXP)|(Win2003)', self.profile)
-			if OSType is not None:
+			is_older_windows = self.profile.startswith(('WinXP', 'Win2003'))
+			if is_older_windows:
 				valid_plugins = BASE_PLUGINS + OLDER_WINDOWS_PLUGINS
 			else:
 				valid_plugins = BASE_PLUGINS + NEWER_WINDOWS_PLUGINS
@@ -232,6 +320,9 @@ class MemoryImage(object):
 
 			self.valid_plugins = valid_plugins
 
+		logging.info('[%s] Queuing %d plugins: %s', self.basename, len(self.valid_plugins),
+			', '.join(plugin.split()[0] for plugin in self.valid_plugins))
+
 
 class Task:
 	def __init__(self, image_basename, plugin, output_path, commandline):
@@ -250,35 +341,60 @@ def generate_future_tasks(image):
 	Yields:
 		- Task containing command to run a plugin.
 	"""
+	image_name = image.image_name
+	image_basename = image.basename
+	output_directory = image.output_directory
+
+	# Arguments shared by every plugin run against this image
+	base_commandline = [
+		image.invocation,
+		'-f', image.abspath,
+		'--profile=' + image.profile,
+		'--kdbg=' + image.kdbg
+	]
+
 	for plugin in image.valid_plugins:
 		plugin_name, plugin_flags = process_plugin(image, plugin)
 
-		output_filename = f'{image.image_name}_{plugin_name}.txt'
-		output_path = os.path.join(image.output_directory, output_filename)
+		output_filename = f'{image_name}_{plugin_name}.txt'
+		output_path = os.path.join(output_directory, output_filename)
 
-		commandline = [
-			image.invocation,
-			'-f', image.abspath,
-			'--profile=' + image.profile,
-			'--kdbg=' + image.kdbg,
-			plugin_name
-		]
+		commandline = base_commandline + [plugin_name]
 		commandline += plugin_flags
 
-		yield Task(image.basename, plugin_name, output_path, commandline) 
+		yield Task(image_basename, plugin_name, output_path, commandline) 
 
 
-def execute_task(task):
+def execute_task(task, workers, workers_lock, stopping):
 	"""
-	Execute a task to run a Volatility plugin on a separate process.
+	Run a Volatility plugin as a child process and wait for it to finish.
+
+	The running process is tracked in workers (keyed by PID) so it can be terminated on interrupt.
+	Launching and registering happen under workers_lock, and no plugin is launched once stopping
+	is set, so the interrupt handler can't miss a process that is just starting.
 	"""
-	logging.info('[{0}] Running Plugin: {1}'.format(task.image_basename, task.plugin))
+	with workers_lock:
+		if stopping.is_set():
+			logging.debug('[%s] Skipping plugin %s after interrupt', task.image_basename, task.plugin)
+			return
+
+		logging.info('[%s] Running Plugin: %s', task.image_basename, task.plugin)
+		with open(task.output_path, 'w') as output:
+			process = subprocess.Popen(task.commandline, stderr=subprocess.STDOUT, stdout=output)
+		workers[process.pid] = process
 
-	with open(task.output_path, 'w') as output:
-		subprocess.call(task.commandline, stderr=subprocess.STDOUT, stdout=output)
+	process.wait()
+	with workers_lock:
+		workers.pop(process.pid)
 
-	logging.info('[{0}] Plugin {1} output saved to {2}'.format(task.image_basename, 
-		task.plugin, task.output_path))
+	# A negative return code means the plugin was killed by a signal (e.g. terminated on interrupt)
+	if process.returncode != 0:
+		logging.warning('[%s] Plugin %s exited with code %d; partial output in %s',
+			task.image_basename, task.plugin, process.returncode, task.output_path)
+		return
+
+	logging.info('[%s] Plugin %s output saved to %s', task.image_basename,
+		task.plugin, task.output_path)
 
 
 def process_plugin(image, plugin):
@@ -289,14 +405,11 @@ def process_plugin(image, plugin):
 		- plugin_name
 		- plugin_flags
 	"""
-	if len(plugin.split(' ')) == 1:
-		plugin_name = plugin.strip('\n')
-		plugin_flags = []
-		return plugin_name, plugin_flags
-	
-	plugin_name = plugin.split(' ')[0].strip('\n')
-	flags = [arg.strip('\n') for arg in plugin.split(' ')[1:]]
-		
+	# split() with no separator also drops the trailing newline of lines read from a plugin list
+	parts = plugin.split()
+	plugin_name = parts[0]
+	flags = parts[1:]
+
 	plugin_flags = []
 	for flag in flags:
 
@@ -316,11 +429,39 @@ def create_dump_dir(plugin_name, image):
 	"""
 	dump_dir = f'{image.image_name}_{plugin_name}_results'
 	dump_dir_path = os.path.join(image.output_directory, dump_dir)
-	if not os.path.exists(dump_dir_path):
-		os.makedirs(dump_dir_path)
+	os.makedirs(dump_dir_path, exist_ok=True)
 	return dump_dir_path
 
 
+def load_imageinfo_cache(master_output_directory):
+	"""
+	Load cached imageinfo results from the output directory, or return an empty cache.
+	"""
+	cache_path = os.path.join(master_output_directory, IMAGEINFO_CACHE_FILENAME)
+	try:
+		with open(cache_path, 'r') as ifile:
+			imageinfo_cache = json.load(ifile)
+	except FileNotFoundError:
+		return {}
+	except (OSError, ValueError) as e:
+		logging.warning('Ignoring unreadable imageinfo cache %s: %s', cache_path, e)
+		return {}
+
+	if not isinstance(imageinfo_cache, dict):
+		logging.warning('Ignoring imageinfo cache %s: expected a JSON object', cache_path)
+		return {}
+	return imageinfo_cache
+
+
+def save_imageinfo_cache(master_output_directory, imageinfo_cache):
+	"""
+	Save imageinfo results to the output directory so later runs can skip auto-detection.
+	"""
+	cache_path = os.path.join(master_output_directory, IMAGEINFO_CACHE_FILENAME)
+	with open(cache_path, 'w') as ofile:
+		json.dump(imageinfo_cache, ofile, indent=4)
+
+
 def main():
 	parser = argparse.ArgumentParser(description='Run multiple Volatility plugins against target image file(s) simultaneously.',
 		epilog='''If no profile or KDBG offset is provided, profile auto-detection will be run (using '
@@ -337,24 +478,24 @@ def main():
 						help='Include plugins that dump all processes, drivers and files from memory.')
 	parser.add_argument('image_files', help='Path to memory image(s)', nargs='+')
 	args = parser.parse_args()
-	logging.info(f'Bulk Volatility Scanner running over {len(args.image_files)} image(s).')
+	logging.info('Bulk Volatility Scanner running over %d image(s).', len(args.image_files))
 
 	invocation = args.invocation if args.invocation else DEFAULT_VOL_INVOCATION
 	output_dir = args.output_dir if args.output_dir else DEFAULT_OUTPUT_DIR
 	extract_artifacts = True if args.extract_artifacts else DEFAULT_EXTRACT_ARTIFACTS
 
 	master_output_directory = os.path.abspath(output_dir)
-	if not os.path.exists(master_output_directory):
-		os.makedirs(master_output_directory)
-	logging.info(f'Output will be saved to: {master_output_directory}')
+	os.makedirs(master_output_directory, exist_ok=True)
+	logging.info('Output will be saved to: %s', master_output_directory)
 
 	profile = args.profile
 	kdbg = args.kdbg
 	plugins_list = args.readlist
 	tasks = []
-	workers = []
+	workers = {}
+	workers_lock = threading.Lock()
+	stopping = threading.Event()
 
-	# Determine profiles and queue tasks for each memory image
 	images = []
 	for image_path in args.image_files:
 		image = MemoryImage(
@@ -363,43 +504,49 @@ def main():
 			profile,
 			kdbg, 
 			master_output_directory,
-			plugins_list,
 			extract_artifacts
 		)
 		images.append(image)
-		tasks.extend([task for task in generate_future_tasks(image)])
-
-	# While pending tasks exist or workers are still processing:
-	while (len(tasks) != 0) or (len(workers) != 0):
-		logging.debug('Active Workers: {0}, Pending Tasks: {1}'.format(
-			len(workers), len(tasks)))
 
+	# Determine profiles concurrently; each detection mostly waits on its own imageinfo process
+	imageinfo_cache = load_imageinfo_cache(master_output_directory)
+	loaded_cache = dict(imageinfo_cache)
+	try:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_SIMULTANEOUS_WORKERS) as executor:
+			list(executor.map(lambda image: image.detect_profile_and_kdbg(imageinfo_cache), images))
+	finally:
+		# Keep results for images that were detected even if another image's detection failed,
+		# and only touch the output directory if a detection was actually added
+		if imageinfo_cache != loaded_cache:
+			save_imageinfo_cache(master_output_directory, imageinfo_cache)
+
+	# Queue tasks for each memory image
+	for image in images:
+		image.populate_valid_plugins(plugins_list)
+		tasks.extend(generate_future_tasks(image))
+
+	# Start the longest-running plugins first to shorten the overall run
+	tasks.sort(key=lambda task: PLUGIN_WEIGHTS.get(task.plugin, DEFAULT_PLUGIN_WEIGHT), reverse=True)
+
+	# Each worker thread blocks on its own Volatility process, so a new task starts
+	# as soon as any running plugin finishes.
+	with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_SIMULTANEOUS_WORKERS) as executor:
+		futures = {executor.submit(execute_task, task, workers, workers_lock, stopping): task
+			for task in tasks}
 		try:
-			# If there are more pending tasks and we haven't reached our max worker count,
-			# spin up a worker to start a new task.
-			if len(tasks) > 0 and len(workers) < MAX_SIMULTANEOUS_WORKERS:
-				task = tasks.pop()
-				process = multiprocessing.Process(target=execute_task, args=(task,))
-				workers.append({
-					'plugin': task.plugin, 
-					'image_basename': task.image_basename,
-					'process': process})
-				process.start()
-			# Otherwise, poll workers intermittently and terminate finished workers 
-			else:
-				time.sleep(5)
-				logging.debug('Polling workers....')
-				for i, worker in enumerate(workers):
-					logging.debug('[{0}] Worker for {1} is still alive?: {2}'.format(
-						worker['image_basename'], worker['plugin'], worker['process'].is_alive()))
-					if not worker['process'].is_alive():
-						logging.debug('[{0}] Terminating finished worker for {1}'.format(
-							worker['image_basename'], worker['plugin']))
-						workers.pop(i)
+			for completed, future in enumerate(concurrent.futures.as_completed(futures), 1):
+				if future.exception():
+					task = futures[future]
+					logging.error('[%s] Plugin %s failed: %s', task.image_basename, task.plugin,
+						future.exception())
+				logging.debug('Completed Tasks: %d/%d', completed, len(futures))
 		except KeyboardInterrupt:
-			for worker in workers:
-				worker['process'].terminate()
-			break
+			with workers_lock:
+				stopping.set()
+				for future in futures:
+					future.cancel()
+				for process in workers.values():
+					process.terminate()
 
 	logging.info('Processing complete. Exiting gracefully.')
 	sys.exit()